@@ -0,0 +1,74 @@
+#!/usr/bin/env python3
+''' Measures buildcc's memory overhead per source file on a generated project. Usage: bench_memory.py [SOURCES] '''
+
+import os, sys, gc, time, tempfile, tracemalloc
+import xml.etree.cElementTree as ET
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+def write_project(dir: str, n: int) -> str:
+    ''' A project with `n` sources: half as <object src> tags, half from a fileset, all using presets. '''
+    root = ET.Element('buildcc', name='bench', default='all')
+
+    base = ET.SubElement(root, 'preset', name='base')
+    for i in range(8):
+        ET.SubElement(base, 'include', dir='include/dir%d' % i)
+        ET.SubElement(base, 'define', key='MACRO_%d' % i)
+    ET.SubElement(ET.SubElement(root, 'preset', name='release', parent='base'), 'opt').text = '-O2'
+
+    os.makedirs(os.path.join(dir, 'src'))
+    fileset = ET.SubElement(root, 'fileset', name='src')
+    for i in range(n // 2, n):
+        open(os.path.join(dir, 'src', 'file%06d.c' % i), 'w').close()
+    ET.SubElement(fileset, 'wildcard', pattern='src/*.c')
+
+    target = ET.SubElement(root, 'target', name='all')
+    exe = ET.SubElement(target, 'executable', output='bench', lang='c')
+    for i in range(n // 2):
+        ET.SubElement(exe, 'object', lang='c', src='src/obj%06d.c' % i, preset='release')
+    ET.SubElement(exe, 'object', lang='c', **{'src-set': 'src', 'preset': 'release'})
+
+    path = os.path.join(dir, 'build.xml')
+    ET.ElementTree(root).write(path)
+    return path
+
+def obj_files(exe):
+    # Older trees have no BinaryTask.obj_files and flatten the object files on every use
+    if hasattr(type(exe), 'obj_files'):
+        return exe.obj_files
+
+    from misc import flatten
+    return flatten([obj.get_files() for obj in exe.objects])
+
+def main():
+    n = int(sys.argv[1]) if len(sys.argv) > 1 else 20000
+
+    from pybuildcc import Project
+
+    with tempfile.TemporaryDirectory() as dir:
+        path = write_project(dir, n)
+
+        gc.collect()
+        tracemalloc.start()
+        start = time.perf_counter()
+
+        project = Project(path)
+        exe = project.targets['all'].tasks[0]
+        for obj in exe.objects:     # What run() does before compiling
+            obj.apply_preset(project.presets)
+        for _ in range(3):  # Logging, linking and the build state all ask for the object files
+            obj_files(exe)
+
+        elapsed = time.perf_counter() - start
+        gc.collect()
+        current, peak = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+
+        sources = sum(len(obj.source) for obj in exe.objects)
+        print('sources:          {}'.format(sources))
+        print('retained:         {:.1f} MiB ({:.0f} bytes/source)'.format(current / 2**20, current / sources))
+        print('peak:             {:.1f} MiB ({:.0f} bytes/source)'.format(peak / 2**20, peak / sources))
+        print('parse + presets:  {:.2f} s'.format(elapsed))
+
+if __name__ == '__main__':
+    main()
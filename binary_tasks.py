@@ -1,21 +1,27 @@
 import xml.etree.cElementTree as ET
-from typing import Dict, List
+from typing import Dict, List, Tuple
 from tasks import Task
 from filegens import FileGenTask
-from misc import log, parse_preset, update_preset, untempl, flatten
+from misc import log, parse_preset, update_preset, untempl, flatten, freeze_preset, FrozenPreset, run_parallel
 from errors import ParseError
-import itertools
+import itertools, sys
 
 import compilers
+import modules
+import jobserver
+
+_for_shlib_presets = {val: freeze_preset({'for-shlib': val}) for val in (False, True)}
 
 class ObjectTask(FileGenTask):  # Inherits Task
-    sources: List[str]
+    __slots__ = ('source', 'file', 'output', 'compiler', 'params', '_preset_name')     # There's one of these for every <object>, which can be a lot
+
+    source: Tuple[str, ...]
     file: str
 
-    output: List[str]
+    output: Tuple[str, ...]
 
     compiler: compilers.Compiler
-    params: Dict
+    params: FrozenPreset    # Shared with every other object using the same parameters
 
     _preset_name: str   # Due to implementation this has to be stored until self.run() is called. (only then is `project` passed to us)
 
@@ -29,52 +35,64 @@ class ObjectTask(FileGenTask):  # Inherits Task
             raise ParseError('`source-set` attribute is deprecated. Switch to `src-set`.')
 
         if 'src' in node.attrib:
-            self.source = [untempl(node.attrib['src'], props)]
+            self.source = (untempl(node.attrib['src'], props),)
         elif 'src-set' in node.attrib:
-            self.source = filesets[node.attrib['src-set']].get_files()
+            self.source = tuple(filesets[node.attrib['src-set']].get_files())
         else:
             self.source = None
 
         self.file   = untempl(node.attrib['file'], props)   if 'file'   in node.attrib else None  # file overrides source if specified
 
         if self.file:
-            self.output = [self.file]
+            self.output = (self.file,)
         elif 'output' in node.attrib:
-            self.output = [untempl(node.attrib['output'], props)]
+            self.output = (untempl(node.attrib['output'], props),)
         else:
-            self.output = [path + '.o' for path in self.source]
+            self.output = tuple(path + '.o' for path in self.source)
 
         self.compiler = compilers.find(
             name=node.attrib['compiler'] if 'compiler' in node.attrib else None, # name overrides lang if specified
             lang=node.attrib['lang']     if 'lang'     in node.attrib else None
         )
 
-        self._preset_name = node.attrib['preset'] if 'preset' in node.attrib else None
+        self._preset_name = sys.intern(node.attrib['preset']) if 'preset' in node.attrib else None
         self.params = parse_preset(node, props)
 
         self.for_shlib = False
 
-    def run(self, project):
-        # Apply preset
+    def apply_preset(self, presets: Dict):
         if self._preset_name:
-            preset = project.presets[self._preset_name]
-            preset = update_preset(preset, self.params)
-            self.params = preset
+            self.params = update_preset(presets[self._preset_name], self.params)
+            self._preset_name = None
+
+    def run(self, project):
+        self.apply_preset(project.presets)
+
+        if self.file:
+            return
+
+        if self.uses_modules:
+            modules.build([self], project)
+        else:
+            compile_sources([self])
 
-        if not self.file:
-            for i in range(len(self.source)):
-                log(1, 'compile {} -> {}'.format(self.source[i], self.output[i]))
-                self.compiler.create_object(self.output[i], self.source[i], self.params)
+    def compile(self, i: int):
+        log(1, 'compile {} -> {}'.format(self.source[i], self.output[i]))
+        self.compiler.create_object(self.output[i], self.source[i], self.params)
 
     def get_files(self):
         return self.output
 
+    @property
+    def uses_modules(self) -> bool:
+        return self.params.get('modules', 'false') == 'true'
+
     @property
     def for_shlib(self) -> bool:
         return self.params.get('for-shlib', False)
     @for_shlib.setter
     def for_shlib(self, val: bool):
-        self.params['for-shlib'] = val
+        self.params = update_preset(self.params, _for_shlib_presets[val])
 
     def __repr__(self):
         if self.file:
@@ -89,9 +107,10 @@ class BinaryTask(Task):
     linked_libs: List[str]
 
     compiler: compilers.Compiler
-    params: Dict
+    params: FrozenPreset
 
     _preset_name: str   # Due to implementation this has to be stored until self.run() is called. (only then is `project` passed to us)
+    _obj_files: Tuple[str, ...]
 
     def __init__(self, node, props: Dict, **kwargs):
         # Parse attributes
@@ -108,12 +127,56 @@ class BinaryTask(Task):
         # Parse ingredients (subtags)
         self.objects = []
         self.linked_libs = []
+        self._obj_files = None
 
     def apply_preset(self, presets: Dict):
         if self._preset_name:
-            preset = project.presets[self._preset_name]
-            preset = update_preset(preset, self.params)
-            self.params = preset
+            self.params = update_preset(presets[self._preset_name], self.params)
+            self._preset_name = None    # Don't apply it twice if we're run again
+
+    @property
+    def obj_files(self) -> Tuple[str, ...]:
+        ''' The object files to link. Known once the objects have been parsed, so only built once. '''
+        if self._obj_files is None:
+            self._obj_files = tuple(flatten([obj.get_files() for obj in self.objects]))
+        return self._obj_files
+
+    def link(self, project, create, obj_files: Tuple[str, ...]):
+        ''' Calls `create` (one of the compiler's create_* methods) unless the output is already
+            linked from the same objects, library interfaces and parameters. '''
+        output = untempl(self.output, project.props)
+        signature = project.state.link_signature(self.compiler.name, obj_files, self.linked_libs, self.params)
+
+        if project.state.is_current(output, signature):
+            log(1, 'up to date: {}'.format(output))
+            return
+
+        log(1, 'compile {} -> {}'.format(str(list(obj_files)), output))
+        create(output, obj_files, self.linked_libs, self.params)
+        project.state.record(output, signature)
+
+    def compile_objects(self, project):
+        ''' Objects which use C++ modules are compiled together, so they can import each other. '''
+        for obj in self.objects:
+            obj.apply_preset(project.presets)
+
+        compile_sources([obj for obj in self.objects if not obj.uses_modules and not obj.file])
+
+        module_objs = [obj for obj in self.objects if obj.uses_modules and not obj.file]
+        if module_objs:
+            modules.build(module_objs, project)
+
+def compile_sources(objects: List[ObjectTask]):
+    ''' Compiles the sources of object tasks which don't use C++ modules. With a jobserver to limit
+        the number of jobs they're compiled concurrently, like in modules.build(). '''
+    jobs = [(lambda obj=obj, i=i: obj.compile(i)) for obj in objects for i in range(len(obj.source))]
+
+    # Watcom compiles to a fixed file name inside DOSBox, so only compilers which run plain command lines can run concurrently
+    if jobserver.current and all(hasattr(obj.compiler, 'object_cmd') for obj in objects):
+        run_parallel(jobs, max_workers=jobserver.current.slots)
+    else:
+        for job in jobs:
+            job()
 
 def get_libpath(node: ET.Element, props: Dict) -> str:
     if 'libpath' in node.attrib:
@@ -133,14 +196,12 @@ class ExecutableTask(BinaryTask):
         self.apply_preset(project.presets)
 
         # Compile objects first
-        for obj in self.objects:
-            obj.run(project)
+        self.compile_objects(project)
 
-        log(1, 'compile {} -> {}'.format(str(flatten([o.get_files() for o in self.objects])), self.output))
-        self.compiler.create_executable(untempl(self.output, project.props), flatten([obj.get_files() for obj in self.objects]), self.linked_libs, self.params)
+        self.link(project, self.compiler.create_executable, self.obj_files)
 
     def __repr__(self):
-        return 'compile({} -> {})'.format(str([o.output for o in self.objects]), self.output)
+        return 'compile({} -> {})'.format(str(list(self.obj_files)), self.output)
 
 class SharedLibTask(BinaryTask):
     def __init__(self, node, props: Dict, **kwargs):
@@ -158,12 +219,9 @@ class SharedLibTask(BinaryTask):
         self.apply_preset(project.presets)
 
         # Compile objects first
-        for obj in self.objects:
-            obj.run(project)
+        self.compile_objects(project)
 
-        obj_files = flatten([o.get_files() for o in self.objects])
-        log(1, 'compile {} -> {}'.format(str(obj_files), self.output))
-        self.compiler.create_shlib(untempl(self.output, project.props), obj_files, self.linked_libs, self.params)
+        self.link(project, self.compiler.create_shlib, self.obj_files)
 
     def __repr__(self):
-        return 'compile({} -> {})'.format(str(flatten([o.get_files() for o in self.objects])), self.output)
+        return 'compile({} -> {})'.format(str(list(self.obj_files)), self.output)
@@ -1,9 +1,10 @@
-from typing import Dict, List
+from typing import Dict, List, Tuple
 from abc import ABC, abstractmethod
 from errors import PlatformError
-from misc import exec_cmd
+from misc import exec_cmd, read_cmd, log
+import jobserver
 
-import os
+import os, re, json
 
 langs = ['c', 'cpp']
 
@@ -24,6 +25,18 @@ class Compiler:
     def create_shlib(self, output: str, objects: List[str], libs: List[str], params: Dict):
         pass
 
+    # Compilers which can run the command lines directly also provide these. They're used
+    # to generate files for other build tools (see ninja.py).
+
+    def object_cmd(self, output: str, source: str, params: Dict, depfile: str = None) -> str:
+        pass
+
+    def executable_cmd(self, output: str, objects: List[str], libs: List[str], params: Dict) -> str:
+        pass
+
+    def shlib_cmd(self, output: str, objects: List[str], libs: List[str], params: Dict) -> str:
+        pass
+
 # Clang
 class Clang:
     def __init__(self, cpp=False):  # clang can compile both C and C++, so we need to register it twice with different names. You can see this done further down.
@@ -37,20 +50,44 @@ class Clang:
             self.is_cpp = False
 
     def create_object(self, output, source, params):
-        cmd = '{ccname} -o {out} -c{g_param}{fpic_param} {src} {inc_dirs} {defines} {opts}'.format(
+        exec_cmd(self.object_cmd(output, source, params))
+
+    def object_cmd(self, output, source, params, depfile=None):
+        return '{ccname} -o {out} -c{g_param}{fpic_param}{dep_param}{mod_params} {src} {inc_dirs} {defines} {opts}'.format(
             ccname = 'clang++' if self.is_cpp else 'clang',
             out=output,
             src=source,
             g_param=' -g' if params.get('debug-symbols', 'false') == 'true' else '',
             fpic_param=' -fPIC' if params.get('for-shlib', False) else '',
+            dep_param=' -MD -MF %s' % depfile if depfile else '',
+            mod_params=''.join([' -fmodule-file=%s' % mod for mod in params.get('module-files', [])])    # `name=path.pcm` for every module this unit imports
+                     + (' -fmodule-output=%s -x c++-module' % params['module-output'] if 'module-output' in params else ''),
             inc_dirs=''.join([' -I %s' % file for file in params.get('includes', [])]),
             defines=''.join([' -D %s' % mac  for mac  in params.get('defines', [])]),
             opts=' '.join(params.get('opts', [])),
         )
-        exec_cmd(cmd)
+
+    def scan_cmd(self, output, source, params, depfile=None):
+        return 'clang-scan-deps -format=p1689 -- ' + self.object_cmd(output, source, params, depfile=depfile)
+
+    def scan_modules(self, output, source, params) -> Tuple[Dict, List[str]]:
+        ''' Returns the P1689 rule for `source` (the C++ modules it provides and requires) and the files it includes. '''
+        depfile = output + '.scan.d'
+        rules = json.loads(read_cmd(self.scan_cmd(output, source, params, depfile=depfile))).get('rules', [])
+
+        try:
+            deps = read_depfile(depfile)
+            os.remove(depfile)
+        except FileNotFoundError:   # Older versions of clang-scan-deps don't write it
+            deps = []
+
+        return (rules[0] if rules else {}), deps
 
     def create_executable(self, output, objects, libs, params):
-        cmd = '{ccname} -{g_param}o {out} {objs} {inc_dirs} {defines} {link_libs} {opts}'.format(
+        exec_cmd(self.executable_cmd(output, objects, libs, params))
+
+    def executable_cmd(self, output, objects, libs, params):
+        return '{ccname} -{g_param}o {out} {objs} {inc_dirs} {defines} {link_libs} {opts}'.format(
             ccname = 'clang++' if self.is_cpp else 'clang',
             out=output,
             objs=' '.join(objects),
@@ -60,10 +97,13 @@ class Clang:
             link_libs=''.join([' -Wl,-rpath,"{dir}" -L {dir} -l:{file}'.format(dir=os.path.dirname(path), file=os.path.basename(path)) for path in libs]),   # That colon in `-l:` is important because it disables the lib-prefix nonsense
             opts=' '.join(params.get('opts', [])),
         )
-        exec_cmd(cmd)
+
     # https://stackoverflow.com/questions/12637841/what-is-the-soname-option-for-building-shared-libraries-for
     def create_shlib(self, output, objects, libs, params):
-        cmd = '{ccname} -shared -{g_param}o {out} {objs} {inc_dirs} {defines} {link_libs} {opts}'.format(
+        exec_cmd(self.shlib_cmd(output, objects, libs, params))
+
+    def shlib_cmd(self, output, objects, libs, params):
+        return '{ccname} -shared -{g_param}o {out} {objs} {inc_dirs} {defines} {link_libs} {opts}'.format(
             ccname = 'clang++' if self.is_cpp else 'clang',
             out=output,
             objs=' '.join(objects),
@@ -73,7 +113,6 @@ class Clang:
             link_libs=''.join([' -Wl,-rpath,"{dir}" -L {dir} -l:{file}'.format(dir=os.path.dirname(path), file=os.path.basename(path)) for path in libs]),   # That colon in `-l:` is important because it disables the lib-prefix nonsense
             opts=' '.join(params.get('opts', [])),
         )
-        exec_cmd(cmd)
 
 # Watcom
 
@@ -128,7 +167,8 @@ class Watcom:                           # Tested with OpenWatcom 1.9
 
         log(2, cmd)
         log(3, "Final DOSBOX command is:\n" + dosboxcmd)
-        os.system(dosboxcmd)
+        with jobserver.job_slot():
+            os.system(dosboxcmd)
 
     @staticmethod
     def path_to_dos(path, pathbase=''):  # path needs to be absolute and every dir needs to be accessible.
@@ -167,6 +207,17 @@ class Watcom:                           # Tested with OpenWatcom 1.9
 #wcl /l=dos /fe=BLARG.EXE HELLO.OBJ
 #
 
+def read_depfile(path: str) -> List[str]:
+    ''' The prerequisites listed in a Makefile-style dependency file, as written by `-MD -MF`. '''
+    with open(path) as f:
+        text = f.read().replace('\\\n', ' ')
+
+    deps = []
+    for line in text.splitlines():
+        _, _, prereqs = line.partition(': ')
+        deps += [dep.replace('\\ ', ' ') for dep in re.split(r'(?<!\\)\s+', prereqs.strip()) if dep]
+    return deps
+
 compilers = [Clang(cpp=True), Clang(cpp=False), Watcom(cpp=False)]
 
 def find(name=None, lang=None):
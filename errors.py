@@ -7,3 +7,7 @@ class ParseError(Exception):
 class PlatformError(Exception):     # An incompatibility with the compiler's target platform
     def __init__(self, msg, compiler=None):
         self.msg = msg
+
+class DependencyError(Exception):   # E.g. a cycle between C++ modules
+    def __init__(self, msg):
+        self.msg = msg
@@ -8,6 +8,7 @@ from tasks import Task
 
 class FileGenTask(Task):
     ''' Any task which generates a file and can be nested '''
+    __slots__ = ()
 
     def __init__(self, node: ET.Element, props: Dict, **kwargs):
         pass
@@ -0,0 +1,165 @@
+from typing import Optional
+from contextlib import contextmanager
+import os, re, select, struct, threading, fcntl, termios
+import misc
+
+# GNU make jobserver protocol: https://www.gnu.org/software/make/manual/html_node/POSIX-Jobserver.html
+#
+# Every process owns one implicit job slot. Any job beyond that needs a token (one byte)
+# read from the jobserver, which has to be written back once the job is done.
+
+_auth_re = re.compile(r'--jobserver-(?:auth|fds)=(\S+)')
+_jobs_re = re.compile(r'(?:^|\s)-j(\d+)')
+
+class JobServer:
+    read_fd: int
+    write_fd: int
+    slots: Optional[int]    # Total number of job slots, if known
+
+    def __init__(self, read_fd: int, write_fd: int, slots: int = None):
+        self.read_fd  = read_fd
+        self.write_fd = write_fd
+        self.slots = slots
+        self._lock = threading.Lock()
+        self._implicit_free = True
+        self._wake_r, self._wake_w = os.pipe()  # Wakes up threads waiting for a token when the implicit slot frees up
+        os.set_blocking(self._wake_r, False)
+
+        # The jobserver's descriptors are shared with make and the other clients, so their
+        # blocking mode can't be changed. Where possible we read through our own non-blocking
+        # file description of the same pipe. Otherwise only one thread reads at a time.
+        self._nonblock_fd = _reopen_nonblocking(read_fd)
+        self._reader = threading.Lock()
+
+    @staticmethod
+    def from_makeflags(makeflags: str) -> Optional['JobServer']:
+        ''' Connects to the jobserver of a parent make, if MAKEFLAGS names one. '''
+        matches = _auth_re.findall(makeflags)
+        if not matches:
+            return None
+        auth = matches[-1]  # The last one wins, like in make
+
+        jobs = _jobs_re.findall(makeflags)
+        slots = int(jobs[-1]) if jobs else None
+
+        try:
+            if auth.startswith('fifo:'):
+                fd = os.open(auth[len('fifo:'):], os.O_RDWR)
+                return JobServer(fd, fd, slots)
+            else:
+                read_fd, write_fd = (int(fd) for fd in auth.split(','))
+                if read_fd < 0 or write_fd < 0:     # make passes -2,-2 to commands that aren't marked as recursive
+                    raise OSError()
+                os.fstat(read_fd)
+                os.fstat(write_fd)
+                return JobServer(read_fd, write_fd, slots)
+        except (OSError, ValueError):
+            misc.log(1, 'Warning: jobserver `{}` from MAKEFLAGS is not available, running without it. (Prefix the buildcc command with `+` in the Makefile.)'.format(auth))
+            return None
+
+    @staticmethod
+    def create(jobs: int) -> 'JobServer':
+        ''' Starts our own jobserver with `jobs` slots and advertises it to child processes through MAKEFLAGS. '''
+        read_fd, write_fd = os.pipe()
+        os.set_inheritable(read_fd,  True)
+        os.set_inheritable(write_fd, True)
+        os.write(write_fd, b'+' * (jobs - 1))   # We hold the implicit slot ourselves
+
+        makeflags = os.environ.get('MAKEFLAGS', '')
+        makeflags = re.sub(r'(^|\s)-j\d*|' + _auth_re.pattern, '', makeflags).strip()
+        os.environ['MAKEFLAGS'] = ' '.join(filter(None, ['-j{}'.format(jobs), '--jobserver-auth={},{}'.format(read_fd, write_fd), makeflags]))
+
+        return JobServer(read_fd, write_fd, jobs)
+
+    def acquire(self) -> Optional[bytes]:
+        ''' Blocks until a job slot is free. Returns the token to pass to release(). '''
+        while True:
+            with self._lock:
+                if self._implicit_free:
+                    self._implicit_free = False
+                    return None
+
+            if self._nonblock_fd is not None:
+                token = self._wait_token(self._nonblock_fd, timeout=None)
+            elif self._reader.acquire(blocking=False):
+                try:
+                    token = self._wait_token(self.read_fd, timeout=0.1)
+                finally:
+                    self._reader.release()
+            else:
+                # Another thread is reading; wait for it or for the implicit slot.
+                readable, _, _ = select.select([self._wake_r], [], [], 0.1)
+                if readable:
+                    self._drain_wake()
+                token = None
+
+            if token:
+                return token
+
+    def _wait_token(self, fd: int, timeout: Optional[float]) -> Optional[bytes]:
+        ''' Waits for `fd` or the wake-up pipe. Returns a token, or None to re-check the implicit slot. '''
+        readable, _, _ = select.select([fd, self._wake_r], [], [], timeout)
+
+        if self._wake_r in readable:
+            self._drain_wake()
+            return None
+
+        if fd not in readable:
+            return None
+
+        if fd == self.read_fd:
+            # Blocking descriptor: don't read unless a byte is there, or we could get stuck if
+            # another process takes it first.
+            if struct.unpack('i', fcntl.ioctl(fd, termios.FIONREAD, b'\0\0\0\0'))[0] == 0:
+                return None
+
+        try:
+            return os.read(fd, 1) or None
+        except BlockingIOError:     # Another process got it first
+            return None
+
+    def _drain_wake(self):
+        try:
+            os.read(self._wake_r, 64)
+        except BlockingIOError:     # Another waiting thread drained it
+            pass
+
+    def release(self, token: Optional[bytes]):
+        if token is None:
+            with self._lock:
+                self._implicit_free = True
+            os.write(self._wake_w, b'!')
+        else:
+            os.write(self.write_fd, token)
+
+def _reopen_nonblocking(fd: int) -> Optional[int]:
+    ''' Opens a new, non-blocking file description for the pipe behind `fd` (Linux only). '''
+    try:
+        return os.open('/proc/self/fd/{}'.format(fd), os.O_RDONLY | os.O_NONBLOCK)
+    except OSError:
+        return None
+
+current: Optional[JobServer] = None
+
+def setup(jobs: int = None):
+    ''' With `jobs`, act as a jobserver for everything we start. Otherwise use our parent make's jobserver, if any. '''
+    global current
+
+    if jobs:
+        if _auth_re.search(os.environ.get('MAKEFLAGS', '')):
+            misc.log(1, 'Warning: -j{} given, not using the jobserver from the parent make.'.format(jobs))
+        current = JobServer.create(jobs)
+    else:
+        current = JobServer.from_makeflags(os.environ.get('MAKEFLAGS', ''))
+
+@contextmanager
+def job_slot():
+    if current is None:
+        yield
+        return
+
+    token = current.acquire()
+    try:
+        yield
+    finally:
+        current.release(token)
@@ -1,12 +1,26 @@
-import re
+import re, os, sys, signal, threading, subprocess
+from typing import Dict, List, Optional, Tuple
+from collections.abc import Mapping
+from functools import lru_cache
 from os import system
 from errors import *
+import jobserver
 
 global log_level
 log_level = 1
 
+_local = threading.local()  # Per-thread output buffer; set while running inside a <parallel> block
+
+def write_out(text: str):
+    buf = getattr(_local, 'buffer', None)
+    if buf is not None:
+        buf.append(text)
+    else:
+        sys.stdout.write(text)
+        sys.stdout.flush()
+
 def log(lvl, msg):
-    if lvl <= log_level: print(msg)
+    if lvl <= log_level: write_out(f'{msg}\n')
 
 class ExecCommandError(Exception):
     def __init__(self, cmd=None, code=0):
@@ -14,11 +28,133 @@ class ExecCommandError(Exception):
         self.cmd = cmd
         self.code = code
 
-def exec_cmd(cmd: str):
+class CancelledError(Exception):
+    pass
+
+def run_cmd(cmd: str) -> int:
+    ''' Runs a shell command and returns its exit code. Output is captured if we're in a buffered (parallel) context. '''
+    return _run(cmd, capture=False)[0]
+
+def read_cmd(cmd: str) -> str:
+    ''' Runs a shell command and returns its standard output. Its standard error is shown like the output of run_cmd(). '''
+    rc, out = _run(cmd, capture=True)
+    if rc != 0: raise ExecCommandError(cmd, rc)
+    return out
+
+def _run(cmd: str, capture: bool) -> Tuple[int, Optional[str]]:
     log(2, cmd)
-    rc = system(cmd)
+
+    buf = getattr(_local, 'buffer', None)
+    if buf is None:
+        with jobserver.job_slot():
+            if not capture:
+                return system(cmd), None
+            proc = subprocess.run(cmd, shell=True, stdout=subprocess.PIPE, close_fds=False)
+            return proc.returncode, proc.stdout.decode(errors='replace')
+
+    if buf.cancelled.is_set(): raise CancelledError()
+
+    with jobserver.job_slot():
+        if buf.cancelled.is_set(): raise CancelledError()   # We may have waited a while for the slot
+        return _run_buffered(cmd, buf, capture)
+
+def _run_buffered(cmd: str, buf, capture: bool) -> Tuple[int, Optional[str]]:
+    proc = subprocess.Popen(cmd, shell=True, stdout=subprocess.PIPE, stderr=subprocess.PIPE if capture else subprocess.STDOUT, close_fds=False, start_new_session=True)
+    with buf.lock:
+        buf.procs.add(proc)
+        if buf.cancelled.is_set():  # A sibling failed while we were starting; cancel() may already have run
+            _kill(proc)
+    try:
+        out, err = proc.communicate()
+    finally:
+        with buf.lock:
+            buf.procs.discard(proc)
+
+    buf.append((err if capture else out).decode(errors='replace'))
+    if buf.cancelled.is_set(): raise CancelledError()
+    return proc.returncode, out.decode(errors='replace') if capture else None
+
+def _kill(proc: subprocess.Popen):
+    if proc.poll() is None:
+        try:
+            os.killpg(proc.pid, signal.SIGTERM)     # Kill the whole process group, not just the shell
+        except ProcessLookupError:
+            pass
+
+def exec_cmd(cmd: str):
+    rc = run_cmd(cmd)
     if rc != 0: raise ExecCommandError(cmd, rc)
 
+class OutputBuffer:
+    ''' Collects the output of one job so that it can be printed in order once the job is done. '''
+    def __init__(self, cancelled: threading.Event, lock: threading.Lock, procs: set):
+        self.chunks = []
+        self.cancelled = cancelled
+        self.lock  = lock
+        self.procs = procs  # Shared between all jobs of a run_parallel() call, so a failure can kill the others
+
+    def append(self, text: str):
+        self.chunks.append(text)
+
+    def getvalue(self) -> str:
+        return ''.join(self.chunks)
+
+def run_parallel(jobs: List, max_workers: int = None):
+    ''' Runs the callables in `jobs` concurrently. Each job's output is buffered and printed in
+        order. If a job raises, the jobs that haven't finished yet are cancelled (and their output
+        dropped) and the error is re-raised. '''
+    from concurrent.futures import ThreadPoolExecutor
+
+    outer = getattr(_local, 'buffer', None)
+    if outer is not None:
+        # Nested in another run_parallel() (e.g. module scans inside a <parallel> block), so cancelling either one cancels both
+        cancelled, lock, procs = outer.cancelled, outer.lock, outer.procs
+    else:
+        cancelled = threading.Event()
+        lock  = threading.Lock()
+        procs = set()
+    buffers = [OutputBuffer(cancelled, lock, procs) for _ in jobs]
+
+    def run_job(job, buf):
+        _local.buffer = buf
+        try:
+            if cancelled.is_set(): raise CancelledError()
+            return job()
+        except BaseException:
+            cancel()
+            raise
+        finally:
+            _local.buffer = None
+
+    def cancel():
+        cancelled.set()
+        with lock:
+            for proc in procs:
+                _kill(proc)
+
+    error = None
+    with ThreadPoolExecutor(max_workers=max_workers) as pool:
+        futures = [pool.submit(run_job, job, buf) for job, buf in zip(jobs, buffers)]
+
+        try:
+            for future, buf in zip(futures, buffers):
+                try:
+                    future.result()
+                except CancelledError:
+                    continue    # Its output is incomplete, don't print it as if it had finished
+                except Exception as err:
+                    if error is None: error = err
+                write_out(buf.getvalue())
+        except BaseException:
+            # E.g. Ctrl-C. The commands run in their own sessions, so the terminal's SIGINT doesn't reach them.
+            cancel()
+            raise
+
+    if error is not None:
+        raise error
+    if cancelled.is_set():
+        raise CancelledError()  # By the enclosing run_parallel()
+
 import itertools
 def flatten(lst):
     return list(itertools.chain.from_iterable(lst))
@@ -29,7 +165,7 @@ def untempl(text, props):
 
     return re.sub('\${([A-Za-z.\-_]+)}', get_prop, text)
 
-preset_attrs = ['debug-symbols']
+preset_attrs = ['debug-symbols', 'modules']
 def parse_preset(node, props={}):
     preset = {}
 
@@ -49,18 +185,63 @@ def parse_preset(node, props={}):
     for opt_tag in node.iterfind('opt'):
         preset['opts'].append(untempl(opt_tag.text, props))
 
-    return preset
+    return freeze_preset(preset)
 
-def update_preset(preset, more):
-    # Merge lists instead of replacing them
-    includes = preset.get('includes', []) + more.get('includes', [])
-    defines  = preset.get('defines', [])  + more.get('defines', [])
-    opts     = preset.get('opts', [])  + more.get('opts', [])
+class FrozenPreset(Mapping):
+    ''' An immutable preset. Equal presets are interned (see freeze_preset()), so every task
+        with the same parameters shares one instance instead of its own dict and lists. '''
+    __slots__ = ('_items', '_hash')
 
-    preset.update(more)
+    def __init__(self, items: Dict):
+        self._items = items
+        self._hash  = hash(frozenset(items.items()))
 
-    preset['includes'] = includes
-    preset['defines'] = defines
-    preset['opts'] = opts
+    def __getitem__(self, key):
+        return self._items[key]
+
+    def __iter__(self):
+        return iter(self._items)
+
+    def __len__(self):
+        return len(self._items)
+
+    def __hash__(self):
+        return self._hash
+
+    def __eq__(self, other):
+        if isinstance(other, FrozenPreset):
+            return self._hash == other._hash and self._items == other._items
+        return Mapping.__eq__(self, other)
+
+    def __repr__(self):
+        return repr(self._items)
+
+_frozen_presets = {}
+
+def _freeze_value(val):
+    if isinstance(val, str):
+        return sys.intern(val)
+    if isinstance(val, (list, tuple)):
+        return tuple(_freeze_value(v) for v in val)
+    return val
+
+def freeze_preset(preset) -> FrozenPreset:
+    if isinstance(preset, FrozenPreset):
+        return preset
+    frozen = FrozenPreset({sys.intern(k): _freeze_value(v) for k, v in preset.items()})
+    return _frozen_presets.setdefault(frozen, frozen)
+
+def update_preset(preset, more) -> FrozenPreset:
+    ''' Returns `preset` with the values from `more`. Lists are merged instead of replaced. '''
+    return _merge_presets(freeze_preset(preset), freeze_preset(more))
+
+@lru_cache(maxsize=None)
+def _merge_presets(preset: FrozenPreset, more: FrozenPreset) -> FrozenPreset:
+    merged = dict(preset)
+    merged.update(more)
+
+    # Merge lists instead of replacing them
+    for key in ('includes', 'defines', 'opts'):
+        merged[key] = preset.get(key, ()) + more.get(key, ())
 
-    return preset
+    return freeze_preset(merged)
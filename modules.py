@@ -0,0 +1,107 @@
+from typing import Dict, List
+import os
+
+from misc import log, run_parallel
+from errors import PlatformError, DependencyError
+import jobserver
+
+class ModuleUnit:
+    ''' One source file of an object task which uses C++ modules. '''
+    __slots__ = ('source', 'output', 'obj', 'provides', 'requires')
+
+    source: str
+    output: str
+    obj: 'ObjectTask'
+
+    provides: List[str]     # Logical names of the modules (or partitions) it defines
+    requires: List[str]     # Logical names of the modules it imports
+
+    def __init__(self, source: str, output: str, obj):
+        self.source = source
+        self.output = output
+        self.obj = obj
+        self.provides = []
+        self.requires = []
+
+    @property
+    def bmi(self) -> str:
+        ''' Where the compiled module interface (BMI) goes. '''
+        return os.path.splitext(self.output)[0] + '.pcm'
+
+def scan(unit: ModuleUnit, project):
+    compiler = unit.obj.compiler
+    if not hasattr(compiler, 'scan_modules'):
+        raise PlatformError('C++ modules are not supported by this compiler.', compiler=compiler.name)
+
+    cmd = compiler.scan_cmd(unit.output, unit.source, unit.obj.params)
+    cached = project.state.get_scan(unit.source, cmd)
+
+    if cached:
+        unit.provides, unit.requires = cached
+    else:
+        rule, deps = compiler.scan_modules(unit.output, unit.source, unit.obj.params)
+        unit.provides = [mod['logical-name'] for mod in rule.get('provides', [])]
+        unit.requires = [mod['logical-name'] for mod in rule.get('requires', [])]
+        project.state.record_scan(unit.source, cmd, unit.provides, unit.requires, deps)
+
+def schedule(units: List[ModuleUnit]) -> List[List[ModuleUnit]]:
+    ''' Orders the units into waves. Every unit only imports modules provided by earlier waves
+        (or by nothing in `units`, e.g. prebuilt modules), so each wave can be compiled in parallel. '''
+    providers = {}  # module name -> unit
+    for unit in units:
+        for name in unit.provides:
+            if name in providers:
+                raise DependencyError('Module `{}` is provided by both `{}` and `{}`.'.format(name, providers[name].source, unit.source))
+            providers[name] = unit
+
+    deps = {unit: {providers[name] for name in unit.requires if name in providers} - {unit} for unit in units}
+
+    waves = []
+    done = set()
+    while len(done) < len(units):
+        wave = [unit for unit in units if unit not in done and deps[unit] <= done]
+        if not wave:
+            blocked = [unit.source for unit in units if unit not in done]
+            raise DependencyError('Cycle between C++ modules. Could not order: ' + ', '.join(blocked))
+        waves.append(wave)
+        done.update(wave)
+
+    return waves
+
+def module_files(unit: ModuleUnit, providers: Dict[str, ModuleUnit]) -> List[str]:
+    ''' `name=path.pcm` for every module the unit imports, directly or indirectly. '''
+    files = []
+    seen = set()
+    stack = list(unit.requires)
+
+    while stack:
+        name = stack.pop()
+        if name in seen or name not in providers: continue
+        seen.add(name)
+        files.append('{}={}'.format(name, providers[name].bmi))
+        stack.extend(providers[name].requires)
+
+    return sorted(files)
+
+def build(objects: List, project):
+    ''' Compiles the sources of the given object tasks, module interfaces before their importers. '''
+    units = [ModuleUnit(source, output, obj) for obj in objects for source, output in zip(obj.source, obj.output)]
+
+    # Without a jobserver we don't know how many jobs we may run, so stay serial like the rest of the build
+    max_workers = jobserver.current.slots if jobserver.current else 1
+
+    run_parallel([(lambda unit=unit: scan(unit, project)) for unit in units], max_workers=max_workers)
+
+    providers = {name: unit for unit in units for name in unit.provides}
+
+    def compile(unit: ModuleUnit):
+        params = dict(unit.obj.params)
+        params['module-files'] = module_files(unit, providers)
+        if unit.provides:
+            params['module-output'] = unit.bmi
+
+        log(1, 'compile {} -> {}'.format(unit.source, unit.output))
+        unit.obj.compiler.create_object(unit.output, unit.source, params)
+
+    for wave in schedule(units):
+        run_parallel([(lambda unit=unit: compile(unit)) for unit in wave], max_workers=max_workers)
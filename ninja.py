@@ -0,0 +1,261 @@
+from typing import Dict, List
+import os, re, shlex
+
+from tasks import Task, EchoTask, ExecTask, ParallelTask
+from binary_tasks import ObjectTask, BinaryTask, ExecutableTask, SharedLibTask
+from misc import untempl, flatten, log
+from errors import PlatformError
+
+# Placeholders passed to the compiler's *_cmd() methods in place of real paths, so that
+# the rule templates are produced by the exact same code that runs the commands.
+_OUT, _IN, _DEP = '\0out\0', '\0in\0', '\0dep\0'
+
+def escape(text: str) -> str:
+    if '\n' in text:    # `$\n` is a line continuation in ninja, so a newline can't be escaped
+        raise PlatformError('Newlines are not supported by the ninja generator: ' + repr(text))
+    return text.replace('$', '$$')
+
+def escape_path(path: str) -> str:
+    return escape(path).replace(' ', '$ ').replace(':', '$:')
+
+def one_line(cmd: str) -> str:
+    ''' A ninja command is a single line, so the lines of a multi-line command are passed to the shell as separate arguments. '''
+    if '\n' not in cmd:
+        return cmd
+    return 'sh -c "$(printf \'%s\\n\' {})"'.format(' '.join(map(shlex.quote, cmd.split('\n'))))
+
+def template(cmd: str) -> str:
+    return escape(cmd).replace(_OUT, '$out').replace(_IN, '$in').replace(_DEP, '$out.d')
+
+class NinjaWriter:
+    def __init__(self):
+        self.lines = []
+
+    def comment(self, text: str):
+        self.lines.append('# ' + text)
+
+    def newline(self):
+        self.lines.append('')
+
+    def variable(self, key: str, value: str, indent: int = 0):
+        self.lines.append('{}{} = {}'.format('  ' * indent, key, value))
+
+    def rule(self, name: str, command: str, **kwargs):
+        self.lines.append('rule ' + name)
+        self.variable('command', command, indent=1)
+        for key, value in kwargs.items():
+            self.variable(key, value, indent=1)
+        self.newline()
+
+    def build(self, outputs: List[str], rule: str, inputs: List[str] = [], implicit: List[str] = [], order_only: List[str] = [], variables: Dict[str, str] = {}):
+        line = 'build {}: {}'.format(' '.join(map(escape_path, outputs)), rule)
+        if inputs:     line += ' ' + ' '.join(map(escape_path, inputs))
+        if implicit:   line += ' | ' + ' '.join(map(escape_path, implicit))
+        if order_only: line += ' || ' + ' '.join(map(escape_path, order_only))
+        self.lines.append(line)
+
+        for key, value in variables.items():
+            self.variable(key, value, indent=1)
+
+    def default(self, targets: List[str]):
+        self.lines.append('default ' + ' '.join(map(escape_path, targets)))
+
+    def getvalue(self) -> str:
+        return '\n'.join(self.lines) + '\n'
+
+class NinjaGenerator:
+    ''' Writes a build.ninja which runs the same commands as `project.run()` would. '''
+
+    def __init__(self, project, regen_cmd: str):
+        self.project = project
+        self.regen_cmd = regen_cmd
+
+        self.rules = {}         # command template -> rule name
+        self.outputs = {}       # absolute path -> (name of the target which builds it, its edge)
+        self.target = None      # Target whose edges are being written
+        self.rule_lines = NinjaWriter()
+        self.build_lines = NinjaWriter()
+
+        # Libraries linked by path which we also build. Binaries get an implicit dependency on them.
+        self.lib_outputs = {}   # absolute path -> path as written in build.ninja
+        for target in project.targets.values():
+            for task in self.walk(target.tasks):
+                if isinstance(task, SharedLibTask):
+                    output = untempl(task.output, project.props)
+                    self.lib_outputs[os.path.abspath(output)] = output
+
+    @staticmethod
+    def walk(tasks: List[Task]):
+        for task in tasks:
+            if isinstance(task, ParallelTask):
+                yield from NinjaGenerator.walk(task.tasks)
+            else:
+                yield task
+
+    def generate(self, path: str):
+        self.rule_lines.rule('exec', '$cmd', description='$desc')
+        self.rule_lines.rule('regen', template(self.regen_cmd), generator='1', description='Regenerating ' + escape(path))
+
+        self.target = '(build.ninja regeneration)'
+        self.build([path], 'regen', implicit=self.project.files)
+        self.build_lines.newline()
+
+        target_outputs = {}
+        for name, target in self.project.targets.items():
+            self.target = name
+            self.build_lines.comment('Target ' + name)
+            target_outputs[name] = self.target_edges(name, target.tasks)
+            self.build_lines.newline()
+
+        # Targets are phony edges. Their names only get a prefix if they clash with a file we build.
+        phony_names = {}
+        for name, outputs in target_outputs.items():
+            phony = name if os.path.abspath(name) not in self.outputs else 'target-' + name
+            if os.path.abspath(phony) in self.outputs or phony in phony_names.values():
+                raise PlatformError('Target `{}` has the same name as a file that is built, and `{}` is taken too.'.format(name, phony))
+            phony_names[name] = phony
+            self.build_lines.build([phony], 'phony', inputs=outputs)
+
+        if self.project.default:
+            self.build_lines.default([phony_names.get(self.project.default, self.project.default)])
+
+        w = NinjaWriter()
+        w.comment('Generated by buildcc from {}. Do not edit.'.format(', '.join(os.path.basename(f) for f in self.project.files)))
+        w.variable('ninja_required_version', '1.3')
+        w.newline()
+
+        tmp_path = path + '.tmp'
+        with open(tmp_path, 'w') as f:
+            f.write(w.getvalue() + self.rule_lines.getvalue() + self.build_lines.getvalue())
+        os.replace(tmp_path, path)
+
+    def target_edges(self, name: str, tasks: List[Task]) -> List[str]:
+        ''' Emits the build edges for a target's tasks and returns all of their outputs.
+            <exec> and <echo> steps are ordered against the steps around them like
+            in `Project.run()`; compile steps only depend on what they actually use. '''
+        all_outputs = []
+        barrier = []    # Outputs of the last <exec>/<echo> step(s); anything after them waits for them
+
+        for i, task in enumerate(tasks):
+            is_cmd = isinstance(task, (EchoTask, ExecTask)) or (isinstance(task, ParallelTask) and any(isinstance(t, (EchoTask, ExecTask)) for t in self.walk(task.tasks)))
+            order_only = all_outputs if is_cmd else barrier
+
+            outputs = self.task_edges(task, '{}.{}'.format(name, i), list(order_only))
+            all_outputs = all_outputs + outputs
+            if is_cmd:
+                barrier = outputs
+
+        return all_outputs
+
+    def task_edges(self, task: Task, stamp: str, order_only: List[str]) -> List[str]:
+        if isinstance(task, ParallelTask):
+            return flatten([self.task_edges(child, '{}.{}'.format(stamp, i), order_only) for i, child in enumerate(task.tasks)])
+        elif isinstance(task, ExecTask):
+            text = task.text.strip()
+            cmd = one_line(text)
+            if not task.failonerror:    # <exec> ignores the exit code by default
+                cmd = '{} || true'.format(cmd if '\n' in text else 'sh -c ' + shlex.quote(cmd))
+            return self.cmd_edge(cmd, text, task.inputs, task.outputs, stamp, order_only)
+        elif isinstance(task, EchoTask):
+            text = untempl(task.text, self.project.props)
+            return self.cmd_edge(one_line('echo ' + shlex.quote(text)), 'echo ' + text, [], [], stamp, order_only)
+        elif isinstance(task, ObjectTask):
+            return self.object_edges(task, order_only)
+        elif isinstance(task, BinaryTask):
+            return self.binary_edge(task, order_only)
+        else:
+            raise PlatformError('Task `{}` is not supported by the ninja generator.'.format(type(task).__name__))
+
+    def build(self, outputs: List[str], rule: str, inputs: List[str] = [], implicit: List[str] = [], order_only: List[str] = [], variables: Dict[str, str] = {}):
+        ''' Writes a build edge. ninja only allows one edge per output, so a step which is in several
+            targets (e.g. an <executable> in both `compile` and `run`) is only written once. Different
+            commands for the same output are an error. '''
+        edge = (rule, tuple(inputs), tuple(implicit), tuple(sorted(variables.items())))
+        known = [self.outputs.get(os.path.abspath(output)) for output in outputs]
+
+        if all(k is not None and k[1] == edge for k in known):
+            return  # Written for an earlier target
+
+        for output, k in zip(outputs, known):
+            if k is not None:
+                raise PlatformError('`{}` is built by different commands (in targets `{}` and `{}`). ninja needs every output to be built by a single rule.'.format(output, k[0], self.target))
+
+        for output in outputs:
+            self.outputs[os.path.abspath(output)] = (self.target, edge)
+
+        self.build_lines.build(outputs, rule, inputs=inputs, implicit=implicit, order_only=order_only, variables=variables)
+
+    def cmd_edge(self, cmd: str, desc: str, inputs: List[str], outputs: List[str], stamp: str, order_only: List[str]) -> List[str]:
+        # Without declared outputs the step gets a name that is never created, so it always runs.
+        outputs = outputs or ['.buildcc/' + stamp]
+        desc = '; '.join(line.strip() for line in desc.splitlines() if line.strip())
+        self.build(outputs, 'exec', implicit=inputs, order_only=order_only,
+                               variables={'cmd': escape(cmd), 'desc': escape(desc)})
+        return outputs
+
+    def get_rule(self, kind: str, compiler, preset: str, cmd: str, **kwargs) -> str:
+        ''' Returns the rule for a command template, creating it if it doesn't exist yet. '''
+        tmpl = template(cmd)
+        if tmpl in self.rules:
+            return self.rules[tmpl]
+
+        base = re.sub('[^A-Za-z0-9_]', '_', '{}_{}_{}'.format(kind, compiler.name, preset or 'default'))
+        name = base
+        n = 1
+        while name in self.rules.values():
+            n += 1
+            name = '{}_{}'.format(base, n)
+
+        self.rules[tmpl] = name
+        self.rule_lines.rule(name, tmpl, description='{} $out'.format(kind), **kwargs)
+        return name
+
+    @staticmethod
+    def check_compiler(compiler):
+        if not hasattr(compiler, 'object_cmd'):
+            raise PlatformError('The ninja generator does not support this compiler.', compiler=compiler.name)
+
+    def object_edges(self, obj: ObjectTask, order_only: List[str]) -> List[str]:
+        if obj.file:
+            return [obj.file]   # Prebuilt object
+
+        self.check_compiler(obj.compiler)
+
+        preset_name = obj._preset_name
+        obj.apply_preset(self.project.presets)
+
+        if obj.uses_modules:
+            raise PlatformError('The ninja generator does not support C++ modules yet.', compiler=obj.compiler.name)
+
+        cmd = obj.compiler.object_cmd(_OUT, _IN, obj.params, depfile=_DEP)
+        rule = self.get_rule('cc', obj.compiler, preset_name, cmd, depfile='$out.d', deps='gcc')
+
+        for source, output in zip(obj.source, obj.output):
+            self.build([output], rule, inputs=[source], order_only=order_only)
+        return list(obj.output)
+
+    def binary_edge(self, task: BinaryTask, order_only: List[str]) -> List[str]:
+        self.check_compiler(task.compiler)
+
+        preset_name = task._preset_name
+        task.apply_preset(self.project.presets)
+
+        objects = flatten([self.object_edges(obj, order_only) for obj in task.objects])
+        output = untempl(task.output, self.project.props)
+
+        if isinstance(task, SharedLibTask):
+            cmd = task.compiler.shlib_cmd(_OUT, [_IN], task.linked_libs, task.params)
+            kind = 'shlib'
+        else:
+            cmd = task.compiler.executable_cmd(_OUT, [_IN], task.linked_libs, task.params)
+            kind = 'link'
+
+        rule = self.get_rule(kind, task.compiler, preset_name, cmd)
+        libs = [self.lib_outputs[os.path.abspath(lib)] for lib in task.linked_libs if os.path.abspath(lib) in self.lib_outputs]
+
+        self.build([output], rule, inputs=objects, implicit=libs, order_only=order_only)
+        return [output]
+
+def write_ninja(project, regen_cmd: str, path: str = 'build.ninja'):
+    NinjaGenerator(project, regen_cmd).generate(path)
+    log(1, 'Wrote `{}`.'.format(os.path.abspath(path)))
@@ -2,16 +2,17 @@
 
 from abc import ABC, abstractmethod
 from typing import Dict, List
-import os, sys, re
+import os, sys, re, shlex
 
 import xml.etree.cElementTree as ET
 
 from tasks import Task, TASKS
 from filegens import FileGenTask, FileSet
 from misc import untempl, log_level, log, parse_preset, update_preset, ExecCommandError
-import misc
-from errors import ParseError
+import misc, jobserver
+from errors import ParseError, PlatformError, DependencyError
 from conditional import parse_conditional
+from state import BuildState, STATE_FILE
 
 class Project:
     name: str = ''
@@ -21,6 +22,8 @@ class Project:
     props: Dict[str, str]
     presets: Dict[str, Dict[str, str]]
     filesets: Dict[str, FileSet]
+    state: BuildState
+    files: List[str]    # Every XML file that was read, for regenerating generated build files
 
     def __init__(self, file=None):
         self.name = ''
@@ -30,6 +33,8 @@ class Project:
         self.props    = {}
         self.presets  = {}
         self.filesets = {}
+        self.state    = None
+        self.files    = []
 
         self.init_props()
 
@@ -37,9 +42,12 @@ class Project:
             self.parse(file)
 
     def parse(self, file):
-        os.chdir(os.path.dirname(os.path.abspath(file)))
+        file = os.path.abspath(file)
+        os.chdir(os.path.dirname(file))
+        self.files.append(file)
 
         self.set__file(file)    # Initialize _file.* properties
+        self.state = BuildState(os.path.abspath(STATE_FILE))
 
         root = ET.ElementTree(file=file).getroot()
         self.import_xml(root, file=file)
@@ -90,8 +98,7 @@ class Project:
                 # If the node has a parent, get the parent values first and
                 # then overwrite them with this presets params.
                 if 'parent' in node.attrib:
-                    params = get_preset(node.attrib['parent']).copy()
-                    params = update_preset(params, parse_preset(node, self.props))
+                    params = update_preset(get_preset(node.attrib['parent']), parse_preset(node, self.props))
                 else:
                     params = parse_preset(node, self.props)
 
@@ -115,6 +122,7 @@ class Project:
 
     def import_file(self, path: str):
         old_file = self.props.get('_file.path', '')     # Retain old file path so that we can go back to it again after we've imported this
+        self.files.append(os.path.abspath(path))
         self.set__file(path)
 
         root = ET.ElementTree(file=path).getroot()
@@ -136,8 +144,11 @@ class Project:
     def run(self, name):
         target = self.targets[name]
 
-        for task in target.tasks:
-            task.run(self)
+        try:
+            for task in target.tasks:
+                task.run(self)
+        finally:
+            self.state.save()
 
     def __repr__(self):
         s = ''
@@ -167,8 +178,12 @@ def main():
     parser.add_argument('-file', help="Specify build file", default='build.xml')
     parser.add_argument('-v', help="Verbosity: [0-3] (default=1)", default='1')
     parser.add_argument('-p', help="Set a property. Overrides properties from files. [name=value]", action='append', default=[])
+    parser.add_argument('-j', metavar='N', type=int, default=None, help="Compile up to N sources at once (also the limit for <parallel> blocks) and act as a GNU make jobserver for the commands we start, so nested make and buildcc share the N slots. Links and other steps still run one after another. Without this, buildcc uses the jobserver of a parent `make` from MAKEFLAGS, if there is one.")
+    parser.add_argument('-gen', choices=['ninja'], help="Write a build file for another build tool (build.ninja) next to the build file instead of building.")
     args = parser.parse_args()
 
+    invocation_dir = os.getcwd()
+
     if args.objtags:
         objtags_for(args.objtags)
         return
@@ -216,12 +231,26 @@ def main():
 
     log(3, project.__repr__())
 
+    if args.gen == 'ninja':
+        from ninja import write_ninja
+        # The generated file re-runs us the same way when the XML files change
+        regen_cmd = 'cd {} && {} {} {}'.format(shlex.quote(invocation_dir), shlex.quote(sys.executable), shlex.quote(os.path.abspath(sys.argv[0])), ' '.join(map(shlex.quote, sys.argv[1:])))
+        try:
+            write_ninja(project, regen_cmd)
+        except PlatformError as err:
+            print('Error: ' + err.msg)
+        return
+
+    jobserver.setup(args.j)
+
     try:
         tgtname = args.target if args.target else project.default
         log(1, f'Running {"" if args.target else "default "}target `{tgtname}`...')
         project.run(tgtname)
     except ExecCommandError as err:
         print(f'Error: The following command exited with code {err.code}:\n\n{err.cmd}')
+    except (PlatformError, DependencyError) as err:
+        print('Error: ' + err.msg)
     except KeyError as k:
         print('Error: No target named', k)
 
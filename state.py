@@ -0,0 +1,146 @@
+from typing import Dict, List
+import os, json, hashlib, threading, subprocess
+from misc import log
+
+STATE_FILE = '.buildcc-state'
+
+class BuildState:
+    ''' Hashes remembered between runs. Stored as JSON next to the build file. '''
+    path: str
+    files: Dict[str, List]  # path -> [mtime_ns, size, content digest, symbols digest]
+    links: Dict[str, str]   # output -> signature of the inputs it was last linked from
+    scans: Dict[str, List]  # source -> [key, provided module names, required module names, included files]
+
+    def __init__(self, path: str = STATE_FILE):
+        self.path  = path
+        self.files = {}
+        self.links = {}
+        self.scans = {}
+        self._lock = threading.Lock()
+        self._dirty = False     # Only written back if something changed
+
+        try:
+            with open(path) as f:
+                data = json.load(f)
+            self.files = data.get('files', {})
+            self.links = data.get('links', {})
+            self.scans = data.get('scans', {})
+        except FileNotFoundError:
+            pass
+        except (ValueError, AttributeError):
+            log(1, 'Build state `{}` is corrupt, ignoring.'.format(path))
+
+    def save(self):
+        with self._lock:
+            if not self._dirty:
+                return
+            data = {'files': self.files, 'links': self.links, 'scans': self.scans}
+            self._dirty = False
+        tmp_path = self.path + '.tmp'
+        with open(tmp_path, 'w') as f:
+            json.dump(data, f)
+        os.replace(tmp_path, self.path)
+
+    def _entry(self, path: str) -> List:
+        ''' Returns the cached entry for a file, invalidating it if the file changed on disk. '''
+        st = os.stat(path)
+        with self._lock:
+            entry = self.files.get(path)
+            if entry is None or entry[0] != st.st_mtime_ns or entry[1] != st.st_size:
+                entry = [st.st_mtime_ns, st.st_size, None, None]
+                self.files[path] = entry
+                self._dirty = True
+            return entry
+
+    def file_digest(self, path: str) -> str:
+        entry = self._entry(path)
+        if entry[2] is None:
+            h = hashlib.sha1()
+            with open(path, 'rb') as f:
+                for chunk in iter(lambda: f.read(1 << 16), b''):
+                    h.update(chunk)
+            entry[2] = h.hexdigest()
+            self._dirty = True
+        return entry[2]
+
+    def symbols_digest(self, path: str) -> str:
+        ''' Digest of a shared library's exported dynamic symbol table. Anything that isn't
+            a shared object (e.g. a static archive), or has no dynamic symbols, uses the content digest. '''
+        if not is_shared_object(path):
+            return self.file_digest(path)
+
+        entry = self._entry(path)
+        if entry[3] is None:
+            try:
+                proc = subprocess.run(['nm', '-D', '--defined-only', '--format=posix', path],
+                                      stdout=subprocess.PIPE, stderr=subprocess.DEVNULL, check=True)
+            except (OSError, subprocess.CalledProcessError):
+                return self.file_digest(path)
+
+            symbols = []
+            for line in proc.stdout.decode(errors='replace').splitlines():
+                fields = line.split()   # name type [value [size]]
+                if len(fields) < 2: continue
+                name, type = fields[0], fields[1]
+                # Addresses move whenever the code changes, so leave them out. The size of
+                # data objects is part of the interface though (copy relocations).
+                size = fields[3] if len(fields) > 3 and type.upper() in 'BDRV' else ''
+                symbols.append(f'{name} {type} {size}')
+
+            if not symbols:
+                return self.file_digest(path)
+
+            entry[3] = hashlib.sha1('\n'.join(sorted(symbols)).encode()).hexdigest()
+            self._dirty = True
+        return entry[3]
+
+    def link_signature(self, compiler: str, objects: List[str], libs: List[str], params: Dict) -> str:
+        ''' Everything a link depends on: the object contents, the libraries' interfaces and the parameters. '''
+        data = {
+            'compiler': compiler,
+            'objects': [(path, self.file_digest(path)    if os.path.exists(path) else None) for path in objects],
+            'libs':    [(path, self.symbols_digest(path) if os.path.exists(path) else None) for path in libs],
+            'params':  dict(params),
+        }
+        return hashlib.sha1(json.dumps(data, sort_keys=True).encode()).hexdigest()
+
+    def is_current(self, output: str, signature: str) -> bool:
+        return os.path.exists(output) and self.links.get(output) == signature
+
+    def record(self, output: str, signature: str):
+        with self._lock:
+            self.links[output] = signature
+            self._dirty = True
+
+    def scan_key(self, source: str, cmd: str, deps: List[str]) -> str:
+        ''' Module dependency scans are cached until the scan command, the source or one of the files it includes changes.
+            (An `import` can come from a header or a macro.) '''
+        digests = [(path, self.file_digest(path) if os.path.exists(path) else None) for path in [source] + deps]
+        return hashlib.sha1(json.dumps([cmd, digests]).encode()).hexdigest()
+
+    def get_scan(self, source: str, cmd: str):
+        with self._lock:
+            entry = self.scans.get(source)
+        if entry and len(entry) == 4 and entry[0] == self.scan_key(source, cmd, entry[3]):
+            return entry[1], entry[2]
+        return None
+
+    def record_scan(self, source: str, cmd: str, provides: List[str], requires: List[str], deps: List[str]):
+        key = self.scan_key(source, cmd, deps)
+        with self._lock:
+            self.scans[source] = [key, provides, requires, deps]
+            self._dirty = True
+
+def is_shared_object(path: str) -> bool:
+    ''' True for ELF files of type ET_DYN. '''
+    try:
+        with open(path, 'rb') as f:
+            header = f.read(18)
+    except OSError:
+        return False
+
+    if len(header) < 18 or header[:4] != b'\x7fELF':
+        return False
+
+    byteorder = 'little' if header[5] == 1 else 'big'   # EI_DATA
+    return int.from_bytes(header[16:18], byteorder) == 3  # e_type == ET_DYN
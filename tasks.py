@@ -1,10 +1,13 @@
 from typing import Dict, List
 from abc import ABC, abstractmethod
 import xml.etree.cElementTree as ET
-from misc import untempl, log_level, log
+from misc import untempl, log_level, log, run_cmd, run_parallel, ExecCommandError
+from errors import ParseError
 import os
 
 class Task(ABC):
+    __slots__ = ()  # So that subclasses can use __slots__
+
     def __init__(self, node: ET.Element, props: Dict, **kwargs):
         pass
 
@@ -24,14 +27,59 @@ class EchoTask(Task):
 
 class ExecTask(Task):
     text: str
+    inputs: List[str]
+    outputs: List[str]
+    failonerror: bool
+
     def __init__(self, node, props: Dict, **kwargs):
         self.text = untempl(node.text, props) if node.text else ''
+        self.inputs  = untempl(node.attrib['inputs'],  props).split() if 'inputs'  in node.attrib else []
+        self.outputs = untempl(node.attrib['outputs'], props).split() if 'outputs' in node.attrib else []
+        self.failonerror = node.attrib.get('failonerror', 'false') == 'true'
+
     def run(self, project):
-        log(2, self.text)
-        os.system(self.text)
+        if self.up_to_date():
+            log(2, 'skip (up to date): ' + self.text)
+            return
+
+        rc = run_cmd(self.text)
+        if rc != 0 and self.failonerror:
+            raise ExecCommandError(self.text, rc)
+
+    def up_to_date(self) -> bool:
+        ''' True if outputs were declared and all of them are newer than all of the inputs. '''
+        if not self.outputs or not all(os.path.exists(path) for path in self.outputs):
+            return False
+
+        oldest_output = min(os.path.getmtime(path) for path in self.outputs)
+        return all(os.path.exists(path) and os.path.getmtime(path) <= oldest_output for path in self.inputs)
+
     def __repr__(self):
         return 'exec("%s")' % self.text
 
+class ParallelTask(Task):
+    ''' Runs its child tasks concurrently. Output is printed in order; a failing child cancels the rest. '''
+    tasks: List[Task]
+    max: int
+
+    def __init__(self, node, props: Dict, **kwargs):
+        self.max = None     # ThreadPoolExecutor default
+        if 'max' in node.attrib:
+            max = untempl(node.attrib['max'], props)
+            if not max.isdigit() or int(max) < 1:
+                raise ParseError('`max` must be a positive integer.')
+            self.max = int(max)
+
+        self.tasks = []
+        for tasknode in node:
+            self.tasks.append(TASKS[tasknode.tag](tasknode, props=props, **kwargs))
+
+    def run(self, project):
+        run_parallel([(lambda task=task: task.run(project)) for task in self.tasks], max_workers=self.max)
+
+    def __repr__(self):
+        return 'parallel(%s)' % ', '.join(repr(task) for task in self.tasks)
+
 from binary_tasks import ObjectTask, ExecutableTask, SharedLibTask
 
 TASKS = {
@@ -40,4 +88,5 @@ TASKS = {
     'executable': ExecutableTask,
     'shared-library': SharedLibTask,
     'exec': ExecTask,
+    'parallel': ParallelTask,
 }